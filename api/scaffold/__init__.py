@@ -57,6 +57,23 @@ class TimeoutError(Exception):
                 'written.')
 
 
+def xor_bytes(data) -> int:
+    """
+    :param data: bytes, bytearray or any object supporting the buffer protocol.
+    :return: XOR of all the bytes of `data`, or 0 if `data` is empty.
+    """
+    # Fold the upper half of the bytes onto the lower half until one byte
+    # remains. This takes a logarithmic number of big integer operations
+    # instead of one Python operation per byte.
+    n = len(data)
+    value = int.from_bytes(data, 'little')
+    while n > 1:
+        half = (n + 1) // 2
+        value = (value >> (8 * half)) ^ (value & ((1 << (8 * half)) - 1))
+        n = half
+    return value
+
+
 class Signal:
     """
     Base class for all connectable signals in Scaffold. Every :class:`Signal`
@@ -18,10 +18,11 @@
 
 
 from enum import Enum
-from binascii import hexlify
-from scaffold import Pull
+from scaffold import Pull, xor_bytes
 from typing import Tuple, List
 import os.path
+import re
+import sys
 import unittest
 
 
@@ -43,13 +44,26 @@ class Convention(Enum):
     DIRECT = 0x3b
 
 
+# Convention for each valid TS byte value.
+_CONVENTION_BY_TS = {c.value: c for c in Convention}
+
+
+# Translation table for inverse convention decoding: inverse order and polarity
+# of bits of each byte value, so a whole buffer can be converted at once with
+# bytes.translate. Bit reversal is done with multiply, mask and modulus: this
+# spreads copies of the byte so that each bit lands at its mirrored position
+# modulo 1023.
+_INVERSE_TABLE = bytes(
+    (((b ^ 0xff) * 0x0202020202) & 0x010884422010) % 1023
+    for b in range(0x100))
+
+
 def inverse_byte(byte):
     """
     Inverse order and polarity of bits in a byte. Used for ISO7816 inverse
     convention decoding.
     """
-    byte ^= 0xff
-    return int(f'{byte:08b}'[::-1], 2)
+    return _INVERSE_TABLE[byte]
 
 
 def apply_convention(data: bytes, convention: Convention) -> bytes:
@@ -60,7 +74,7 @@ def apply_convention(data: bytes, convention: Convention) -> bytes:
     if convention == Convention.DIRECT:
         return data
     elif convention == Convention.INVERSE:
-        return bytes(inverse_byte(b) for b in data)
+        return bytes(data).translate(_INVERSE_TABLE)
     else:
         raise ValueError("invalid convention")
 
@@ -86,16 +100,22 @@ class ScaffoldISO7816ByteReader:
 class BasicByteReader:
     """ Used for `parse_atr` function with a test vector. """
     def __init__(self, data: bytes):
-        self.data = data
+        # Remaining data. Slicing the view does not copy the bytes.
+        self.data = memoryview(data)
 
     def read(self, n: int) -> bytes:
         if len(self.data) < n:
             raise EOFError()
-        chunk = self.data[:n]
+        chunk = bytes(self.data[:n])
         self.data = self.data[n:]
         return chunk
 
 
+# Number of interface bytes TA, TB, TC and TD announced by a T0 or TD byte,
+# which is the number of bits set in its high nibble.
+_INTERFACE_BYTES_COUNT = tuple(bin(b >> 4).count('1') for b in range(0x100))
+
+
 def parse_atr(reader) -> ATRInfo:
     """
     ATR parsing function used by Smartcard class when reading a card ATR. The
@@ -110,8 +130,8 @@ def parse_atr(reader) -> ATRInfo:
     atr.append(reader.read(1)[0])
     ts = atr[0]
     try:
-        info.convention = Convention(ts)
-    except ValueError as e:
+        info.convention = _CONVENTION_BY_TS[ts]
+    except KeyError as e:
         raise ProtocolError(f'Invalid TS byte in ATR: 0x{ts:02x}') from e
     reader.convention = info.convention
     # Receive T0
@@ -120,14 +140,12 @@ def parse_atr(reader) -> ATRInfo:
     i = 1
     td = atr[i]
     while td is not None:
-        has_t_abcd = list(bool(td & (1 << (j+4))) for j in range(4))
-        count = has_t_abcd.count(True)
-        atr += reader.read(count)
+        atr += reader.read(_INTERFACE_BYTES_COUNT[td])
         # Test to skip T0 byte
         if i != 1:
             info.protocols.add(td & 0x0f)
         # Test TD presence
-        if has_t_abcd[3]:
+        if td & 0x80:
             td = atr[-1]
         else:
             td = None
@@ -135,25 +153,28 @@ def parse_atr(reader) -> ATRInfo:
     # If no protocol is specified, then T=0 is available by default
     if len(info.protocols) == 0:
         info.protocols.add(0)
-    # Fetch historical bytes
-    # Number of historical bytes is the low nibble of T0
-    atr += reader.read(atr[1] & 0x0f)
-    # Parse TCK (check byte)
-    # This byte is absent if only T=0 is supported
-    if info.protocols != {0}:
-    #if True:
-        # TCK expected
-        atr += reader.read(1)
-        tck = atr[-1]
-        # Verify the checksum
-        xored = 0x00
-        for b in atr[1:]:
-            xored ^= b
-        if xored != 0x00:
+    # Fetch historical bytes and TCK (check byte) with a single read.
+    # Number of historical bytes is the low nibble of T0.
+    # TCK is absent if only T=0 is supported.
+    tck_count = 0 if info.protocols == {0} else 1
+    atr += reader.read((atr[1] & 0x0f) + tck_count)
+    if tck_count:
+        # Verify the checksum: XOR of all bytes from T0 to TCK must be null.
+        if xor_bytes(memoryview(atr)[1:]) != 0x00:
             raise ProtocolError('ATR checksum error')
     return info
 
 
+# Path of the smartcard ATR list database, as installed by the pcsc-tools
+# package on debian systems.
+ATR_INFO_DB_PATH = '/usr/share/pcsc/smartcard_list.txt'
+
+# Cache of the parsed ATR database, indexed by file path. Each value is a tuple
+# with the modification time of the file, the parsed table and the compiled
+# ATR patterns.
+_atr_info_db_cache = {}
+
+
 def load_atr_info_db() -> List[Tuple[str, List[str]]]:
     """
     Parse the smartcard ATR list database available at
@@ -167,23 +188,53 @@ def load_atr_info_db() -> List[Tuple[str, List[str]]]:
     ATR values are returned with strings, and can have '.' wildcards for
     matching, or other special formatting characters. With each ATR is returned
     of list of description strings.
+
+    The parsed database is cached and the file is parsed again only if it has
+    been modified. The returned list is a copy which can be modified by the
+    caller.
+    """
+    tab, _ = _atr_info_db(ATR_INFO_DB_PATH)
+    return [(atr, list(info)) for atr, info in tab]
+
+
+def _atr_info_db(path: str):
     """
+    Load the ATR database from the cache, or parse the file if it has not been
+    loaded yet or has been modified since.
+
+    :param path: Database file path.
+    :return: A tuple with the table as returned by :func:`load_atr_info_db`,
+        and a dict giving, for each ATR hexadecimal string length, the list of
+        compiled regular expressions of the ATR patterns of that length with
+        their information lines.
+    """
+    mtime = os.path.getmtime(path)
+    cached = _atr_info_db_cache.get(path)
+    if (cached is not None) and (cached[0] == mtime):
+        return cached[1:]
     tab = []
-    text_file = open('/usr/share/pcsc/smartcard_list.txt', 'r')
-    # We don't want to keep end lines such as LR or CR LF
-    lines = text_file.read().splitlines()
-    text_file.close()
     # Parse the file and build a table with ATR patterns and infos
-    for line in lines:
-        if (len(line) > 0) and (line[0] not in ('#', '\t')):
-            # ATR line
-            atr = line.replace(' ', '').lower()
-            tab.append((atr, []))
-        elif (len(line) > 0) and (line[0] == '\t'):
-            # Info line
-            # Remove first character \t
-            tab[-1][1].append(line[1:])
-    return tab
+    with open(path, 'r') as text_file:
+        for line in text_file:
+            # We don't want to keep end lines such as LR or CR LF
+            line = line.rstrip('\r\n')
+            if (len(line) > 0) and (line[0] not in ('#', '\t')):
+                # ATR line
+                atr = line.replace(' ', '').lower()
+                tab.append((atr, []))
+            elif (len(line) > 0) and (line[0] == '\t'):
+                # Info line
+                # Remove first character \t
+                tab[-1][1].append(line[1:])
+    # '.' is a wildcard in the database, all other characters must match.
+    # Patterns only match strings of their own length, so they are indexed by
+    # length to test only the ones which can match a given ATR.
+    patterns = {}
+    for atr, info in tab:
+        regex = re.compile(re.escape(atr).replace('\\.', '.'))
+        patterns.setdefault(len(atr), []).append((regex, info))
+    _atr_info_db_cache[path] = (mtime, tab, patterns)
+    return tab, patterns
 
 
 class Smartcard:
@@ -280,6 +331,8 @@ class Smartcard:
         """
         if type(the_apdu) == str:
             the_apdu = bytes.fromhex(the_apdu)
+        # Slicing the view does not copy the APDU bytes before transmission.
+        view = memoryview(the_apdu)
         apdu_len = len(the_apdu)
         if apdu_len < 5:
             raise ValueError('APDU too short')
@@ -303,14 +356,14 @@ class Smartcard:
         # Transmit the header
         if 'a' in trigger:
             with self.scaffold.lazy_section():
-                self.iso7816.transmit(the_apdu[:4])
+                self.iso7816.transmit(view[:4])
                 self.iso7816.trigger_long = 1
-                self.iso7816.transmit(the_apdu[4:5])
+                self.iso7816.transmit(view[4:5])
         else:
             # Send all the header at once
             with self.scaffold.lazy_section():
                 self.iso7816.trigger_long = 0
-                self.iso7816.transmit(the_apdu[:5])
+                self.iso7816.transmit(view[:5])
         # Receive procedure byte
         procedure_byte = self.iso7816.receive(1)[0]
         if 'a' in trigger:  # Disable only if enabled previously
@@ -319,24 +372,25 @@ class Smartcard:
             procedure_byte = self.iso7816.receive(1)[0]
         response = bytearray()
         ins = the_apdu[1]
-        if (procedure_byte & 0xf0) in (0x60, 0x90):
+        sw1_high = procedure_byte & 0xf0
+        if sw1_high == 0x60 or sw1_high == 0x90:
             # Received SW1 byte.
             response.append(procedure_byte)
             # Received SW2
             response.append(self.iso7816.receive(1)[0])
             return response
-        elif procedure_byte in (ins, ~ins):
+        elif procedure_byte == ins:
             # Acknowledge byte.
             # Transfer the remaining data
             if out_data_len > 0:
                 if 'b' in trigger:
                     # Enable trigger on last byte only
-                    self.iso7816.transmit(the_apdu[5:-1])
+                    self.iso7816.transmit(view[5:-1])
                     self.iso7816.trigger_long = 1
-                    self.iso7816.transmit(the_apdu[-1:])
+                    self.iso7816.transmit(view[-1:])
                 else:
                     # Send all remaining data at once
-                    self.iso7816.transmit(the_apdu[5:])
+                    self.iso7816.transmit(view[5:])
             # Receive the response data and status word
             response += self.iso7816.receive(in_data_len + 2)
             if 'b' in trigger:  # Disable only if enabled previously
@@ -380,10 +434,7 @@ class Smartcard:
             raise ValueError(f'Cannot set ETU to {etu} because of the '
                 'fractional part (hardware limitation)')
         # Checksum
-        pck = 0
-        for b in request:
-            pck ^= b
-        request.append(pck)
+        request.append(xor_bytes(request))
         # Send the request
         self.iso7816.transmit(request)
         # Get the response
@@ -409,34 +460,27 @@ class Smartcard:
             the card. Return None if the ATR did not match any entry in the
             database.
         """
-        tab = load_atr_info_db()
+        _, patterns = _atr_info_db(ATR_INFO_DB_PATH)
         # Try to match ATR
-        for item in tab:
-            pattern = item[0]
-            atr = hexlify(self.atr).decode()
-            if len(pattern) != len(atr):
-                continue
-            match = True
-            for i in range(len(pattern)):
-                if pattern[i] != '.':
-                    if pattern[i] != atr[i]:
-                        match = False
-                        break
-            if match:
-                return item[1]
-                break
+        atr = self.atr.hex()
+        for pattern, info in patterns.get(len(atr), ()):
+            if pattern.fullmatch(atr):
+                # Copy so the cached database cannot be modified by the caller.
+                return list(info)
 
     def apdu_str(self, the_apdu):
         """
         Same as :meth:`apdu` function, with str argument and return type for
         convenience.
 
-        :param the_apdu: APDU to be sent, as an hexadecimal string.
-        :type the_apdu: str
+        :param the_apdu: APDU to be sent, as an hexadecimal string. bytes are
+            also accepted and sent as is.
+        :type the_apdu: str or bytes
         :return str: Response from the card, as a lowercase hexadecimal string
             without spaces.
         """
-        return hexlify(self.apdu(bytes.fromhex(the_apdu))).decode()
+        # apdu already decodes hexadecimal strings.
+        return self.apdu(the_apdu).hex()
 
     @property
     def card_inserted(self):
@@ -447,6 +491,85 @@ class Smartcard:
         return self.sig_sense.value == 1
 
 
+class TestInverseConvention(unittest.TestCase):
+    def test_inverse_byte(self):
+        for b in range(0x100):
+            expected = int(f'{b ^ 0xff:08b}'[::-1], 2)
+            self.assertEqual(inverse_byte(b), expected)
+
+    def test_apply_convention(self):
+        data = bytes(range(0x100))
+        self.assertEqual(apply_convention(data, Convention.DIRECT), data)
+        self.assertEqual(apply_convention(data, Convention.INVERSE),
+            bytes(inverse_byte(b) for b in data))
+
+
+class TestFindInfo(unittest.TestCase):
+    first_info = ['First card', 'More info']
+
+    def setUp(self):
+        # Only needed by this test, not imported with the module.
+        import tempfile
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.write_db(
+            '# Comment\n'
+            '3B 02 14 50\n'
+            '\tFirst card\n'
+            '\tMore info\n'
+            '\n'
+            '3B 02 .. 50\n'
+            '\tWildcard card\n'
+            '3B 02 14 50\n'
+            '\tDuplicate card\n')
+        module = sys.modules[__name__]
+        self.addCleanup(setattr, module, 'ATR_INFO_DB_PATH', ATR_INFO_DB_PATH)
+        module.ATR_INFO_DB_PATH = self.path
+        self.card = Smartcard.__new__(Smartcard)
+
+    def tearDown(self):
+        _atr_info_db_cache.pop(self.path, None)
+        os.remove(self.path)
+
+    def write_db(self, text, mtime=None):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def find_info(self, atr):
+        self.card.atr = bytes.fromhex(atr)
+        return self.card.find_info()
+
+    def test_match(self):
+        # First matching entry is returned, even if duplicated later.
+        self.assertEqual(self.find_info('3b021450'), self.first_info)
+        self.assertEqual(self.find_info('3b02ff50'), ['Wildcard card'])
+
+    def test_no_match(self):
+        self.assertIsNone(self.find_info('3b0214'))
+        self.assertIsNone(self.find_info('3b02145000'))
+        self.assertIsNone(self.find_info('3b021451'))
+
+    def test_reload(self):
+        self.assertEqual(self.find_info('3b021450'), self.first_info)
+        mtime = os.path.getmtime(self.path) + 10
+        self.write_db('3b 02 14 50\n\tModified card\n', mtime)
+        self.assertEqual(self.find_info('3b021450'), ['Modified card'])
+        self.assertIsNone(self.find_info('3b02ff50'))
+
+    def test_copies(self):
+        load_atr_info_db()[0][1].append('Modified')
+        self.find_info('3b021450').append('Modified')
+        self.assertEqual(load_atr_info_db()[0],
+            ('3b021450', self.first_info))
+        self.assertEqual(self.find_info('3b021450'), self.first_info)
+
+
+# Wildcard or special formatting characters in ATR database patterns.
+_SPECIAL_ATR_CHARS = re.compile(r'[.\[]')
+
+
 class TestATRParser(unittest.TestCase):
     def test_parsing_ok(self):
         tab = load_atr_info_db()
@@ -455,7 +578,7 @@ class TestATRParser(unittest.TestCase):
         # Here are some list of invalid ATR in the database.
 
         # List with incomplete ATR
-        badlist_incomplete = [
+        badlist_incomplete = frozenset([
             "3b260011016d03",
             "3b2f008069af0307066800000a0e8306",
             "3b6b00ff56434152445f4e5353",
@@ -469,10 +592,10 @@ class TestATRParser(unittest.TestCase):
             "3bfa1300008131fe454a434f50343156",
             "3bfd9600008131204380318065b0831148c883009000",
             "3fff9500ff918171a04700444e4153503031312052657642",
-            "3fff9500ff918171fe4700444e41535032343120447368"]
+            "3fff9500ff918171fe4700444e41535032343120447368"])
 
         # List of invalid ATR with too much bytes
-        badlist_extra = [
+        badlist_extra = frozenset([
             "3b02145011",
             "3b101450",
             "3b16964173747269643b021450",
@@ -490,21 +613,20 @@ class TestATRParser(unittest.TestCase):
             "3bf711000140965430040e6cb6d69000",
             "3bf711000140967070070e6cb6d69000",
             "3bf7110001409670700a0e6cb6d69000",
-            "3bfe9600008131fe45803180664090a5102e03830190006e9000"]
+            "3bfe9600008131fe45803180664090a5102e03830190006e9000"])
 
         # List of ATR with invalid checksum
-        badlist_checksum = [
+        badlist_checksum = frozenset([
             "3b888001000000007783950000",
             "3b9e95801fc78031e073fe211b66d0004900c0004a",
             "3bdd97ff81b1fe451f0300640405080373969621d00090c8",
             "3bef00ff8131504565630000000000000000000000000000",
             "3bfe9100ff918171fe40004138002180818066b00701017707b7",
-            "3bff0000ff8131fe458025a000000056575343363530000000"]
+            "3bff0000ff8131fe458025a000000056575343363530000000"])
 
-        atrs = []
-        for atr_pattern, _ in tab:
-            if ('.' not in atr_pattern) and ('[' not in atr_pattern):
-                atrs.append(atr_pattern)
+        # Only test ATR without wildcard or special formatting characters.
+        atrs = [atr_pattern for atr_pattern, _ in tab
+            if not _SPECIAL_ATR_CHARS.search(atr_pattern)]
         for atr in atrs:
             reader = BasicByteReader(bytes.fromhex(atr))
             if atr in badlist_extra:
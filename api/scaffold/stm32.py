@@ -17,7 +17,55 @@
 # Copyright 2019 Ledger SAS, written by Olivier Hériveaux
 
 
+from scaffold import xor_bytes
 from time import sleep
+from typing import List
+import struct
+
+
+def _command_frame(index):
+    """
+    :param index: Bootloader command index.
+    :return: Bytes starting the command: its index followed by the complement.
+    """
+    return bytes((index, index ^ 0xff))
+
+
+# Frames of the bootloader commands, built once.
+_CMD_GET_VERSION = _command_frame(0x01)
+_CMD_READ_MEMORY = _command_frame(0x11)
+_CMD_GO = _command_frame(0x21)
+_CMD_WRITE_MEMORY = _command_frame(0x31)
+_CMD_EXTENDED_ERASE = _command_frame(0x44)
+_CMD_WRITE_PROTECT = _command_frame(0x63)
+_CMD_WRITE_UNPROTECT = _command_frame(0x73)
+_CMD_READOUT_PROTECT = _command_frame(0x82)
+_CMD_READOUT_UNPROTECT = _command_frame(0x92)
+
+
+# Serialize a 32-bit address, most significant byte first.
+_pack_address = struct.Struct('>I').pack
+
+
+def _read_chunks(f, size):
+    """
+    Read a binary file chunk after chunk. Short reads, which can happen with
+    unbuffered files or pipes, are completed so that all chunks but the last
+    one have the requested size.
+
+    :param f: Binary file object.
+    :param size: Chunk size.
+    """
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        while len(chunk) < size:
+            more = f.read(size - len(chunk))
+            if not more:
+                break
+            chunk += more
+        yield chunk
 
 
 class NACKError(Exception):
@@ -32,6 +80,8 @@ class NACKError(Exception):
 
 class MemorySection:
     """ Describes a memory section of a device. """
+    __slots__ = ('start', 'end')
+
     def __init__(self, start, end):
         """
         :param start: First address of the section.
@@ -51,6 +101,8 @@ class MemorySection:
 
 class STM32Device:
     """ Possible name and product ID tuple. """
+    __slots__ = ('name', 'pid', 'memory_mapping', 'offset_rdp')
+
     def __init__(self, name, pid, memory_mapping, offset_rdp=0):
         self.name = name
         self.pid = pid
@@ -111,6 +163,10 @@ class STM32:
         STM32Device('STM32L496xx/4A6xx', 0x461, {}),
         STM32Device('STM32L4Rxx/4Sxx', 0x470, {})]
 
+    # Devices indexed by PID. When several devices share the same PID, the
+    # last one from PIDS is retained.
+    _PID_MAP = {dev.pid: dev for dev in PIDS}
+
     def __init__(self, scaffold):
         """
         :param scaffold: An instance of :class:`scaffold.Scaffold` which will
@@ -137,10 +193,20 @@ class STM32:
         :param data: Input bytes.
         :return: Checksum byte. This is the XOR of all input bytes.
         """
-        result = 0x00
-        for b in data:
-            result ^= b
-        return result
+        if len(data) == 4:
+            # Address frames, the most frequent case.
+            return data[0] ^ data[1] ^ data[2] ^ data[3]
+        return xor_bytes(data)
+
+    def transmit_with_checksum(self, data, trigger=0):
+        """
+        Transmit data followed by its checksum byte, in a single UART
+        transmission.
+
+        :param data: Data to be transmitted. bytes or bytearray.
+        :param trigger: 1 to enable trigger on the last transmitted byte.
+        """
+        self.uart.transmit(data + bytes((self.checksum(data),)), trigger)
 
     def startup_bootloader(self):
         """
@@ -151,9 +217,13 @@ class STM32:
         respond if it is locked in RDP2 state (Readout Protection level 2).
         """
         self.scaffold.power.dut = 0
-        self.boot0 << 1
-        self.boot1 << 0
-        self.nrst << 0
+        # Configure all pins at once, without waiting for each write
+        # acknowledge. Power control register is volatile and must be read
+        # for update, so it cannot be part of the lazy section.
+        with self.scaffold.lazy_section():
+            self.boot0 << 1
+            self.boot1 << 0
+            self.nrst << 0
         sleep(0.1)
         self.scaffold.power.dut = 1
         sleep(0.1)
@@ -169,26 +239,36 @@ class STM32:
         Power-cycle and reset target device and boot from user Flash memory.
         """
         self.scaffold.power.dut = 0
-        self.boot0 << 0
-        self.boot1 << 0
-        self.nrst << 0
+        # Configure all pins at once, as in startup_bootloader.
+        with self.scaffold.lazy_section():
+            self.boot0 << 0
+            self.boot1 << 0
+            self.nrst << 0
         sleep(0.1)
         self.scaffold.power.dut = 1
         sleep(0.1)
         self.nrst << 1
         sleep(0.1)
 
-    def command(self, index):
+    def command(self, index, size=None):
         """
         Send a command and return the response.
 
         :param index: Command index.
+        :param size: Expected response size in bytes, if known in advance. The
+            whole response is then fetched with a single read.
         :return: Response bytes.
         """
-        self.uart.transmit(bytes([index, 0xff ^ index]))
-        res = self.uart.receive(2)
-        assert res[0] == self.ACK
-        data = self.uart.receive(res[1]+2)
+        self.uart.transmit(_command_frame(index))
+        if size is None:
+            res = self.uart.receive(2)
+            assert res[0] == self.ACK
+            data = self.uart.receive(res[1]+2)
+        else:
+            res = self.uart.receive(size+3)
+            assert res[0] == self.ACK
+            assert res[1] == size - 1
+            data = res[2:]
         assert data[-1] == self.ACK
         return data[0:-1]
 
@@ -230,15 +310,14 @@ class STM32:
         try to find information if the ID matches a known device.
         """
         self.device = None
-        response = self.command(0x02)
+        # The PID is always two bytes long.
+        response = self.command(0x02, 2)
         pid = int.from_bytes(response, 'big', signed=False)
-        for dev in self.PIDS:
-            if dev.pid == pid:
-                self.device = dev
+        self.device = self._PID_MAP.get(pid)
         return pid
 
     def get_version_and_read_protection_status(self):
-        self.uart.transmit(b'\x01\xfe')
+        self.uart.transmit(_CMD_GET_VERSION)
         response = self.uart.receive(5)
         assert response[0] == self.ACK
         assert response[-1] == self.ACK
@@ -253,23 +332,19 @@ class STM32:
         :param size: Number of bytes to be read.
         :param trigger: 1 to enable trigger on command transmission.
         """
-        result = bytearray()
-        remaining = length
-        while remaining > 0:
-            chunk_size = min(256, remaining)
-            self.uart.transmit(b'\x11\xee', trigger=trigger)
+        # Allocate the result once and fill it chunk after chunk.
+        result = bytearray(length)
+        offset = 0
+        while offset < length:
+            chunk_size = min(256, length - offset)
+            self.uart.transmit(_CMD_READ_MEMORY, trigger=trigger)
             self.wait_ack()
-            buf = bytearray(address.to_bytes(4, 'big', signed=False))
-            buf.append(self.checksum(buf))
-            self.uart.transmit(buf)
+            self.transmit_with_checksum(_pack_address(address))
             self.wait_ack()
-            buf = bytearray()
-            buf.append(chunk_size-1)
-            buf.append((chunk_size-1) ^ 0xff)
-            self.uart.transmit(buf)
+            self.uart.transmit(bytes((chunk_size - 1, (chunk_size - 1) ^ 0xff)))
             self.wait_ack()
-            result += self.uart.receive(chunk_size)
-            remaining -= chunk_size
+            result[offset:offset + chunk_size] = self.uart.receive(chunk_size)
+            offset += chunk_size
             address += chunk_size
         return result
 
@@ -280,28 +355,33 @@ class STM32:
         larger than 256 bytes, many Write Memory commands are sent.
 
         :param address: Address.
-        :param data: Data to be written. bytes or bytearray.
+        :param data: Data to be written. bytes, bytearray or any object
+            supporting the buffer protocol. A binary file object can also be
+            given, in which case it is read and sent chunk after chunk until
+            its end. If the data size is not a multiple of 4 bytes, as
+            required by the bootloader, it is padded with 0xff bytes.
         :param trigger: 1 to enable trigger on each command transmission.
         """
-        remaining = len(data)
+        if hasattr(data, 'read'):
+            chunks = _read_chunks(data, 256)
+        else:
+            # Slicing the view does not copy the data.
+            view = memoryview(data).cast('B')
+            chunks = (view[i:i + 256] for i in range(0, len(view), 256))
         offset = 0
-        while remaining > 0:
-            chunk_size = min(256, remaining)
-            self.uart.transmit(b'\x31\xce', trigger=trigger)
+        for chunk in chunks:
+            chunk_size = len(chunk)
+            if chunk_size % 4:
+                # Only the last chunk can be incomplete.
+                chunk = bytes(chunk) + b'\xff' * (-chunk_size % 4)
+                chunk_size = len(chunk)
+            self.uart.transmit(_CMD_WRITE_MEMORY, trigger=trigger)
             self.wait_ack(0)
-            buf = bytearray(
-                (address + offset).to_bytes(4, 'big', signed=False))
-            buf.append(self.checksum(buf))
-            self.uart.transmit(buf)
+            self.transmit_with_checksum(_pack_address(address + offset))
             self.wait_ack(1)
-            buf = bytearray()
-            buf.append(chunk_size - 1)
-            buf += data[offset:offset + chunk_size]
-            buf.append(self.checksum(buf))
-            self.uart.transmit(buf)
+            self.transmit_with_checksum(bytes((chunk_size - 1,)) + chunk)
             self.wait_ack(2)
             offset += chunk_size
-            remaining -= chunk_size
 
     def assert_device(self):
         """ Raise a RuntimeError is device is unknown (None). """
@@ -324,7 +404,7 @@ class STM32:
         """
         Execute the Readout Unprotect command.
         """
-        self.uart.transmit(b'\x82\x7d', 1)
+        self.uart.transmit(_CMD_READOUT_PROTECT, 1)
         self.wait_ack()
         self.wait_ack()
 
@@ -333,17 +413,13 @@ class STM32:
         Execute the Readout Unprotect command. If the device is locked, it will
         perform mass flash erase, which can be very very long.
         """
-        self.uart.transmit(b'\x92\x6d', 1)
+        self.uart.transmit(_CMD_READOUT_UNPROTECT, 1)
         self.wait_ack()
         # When the chip is in RDP1 it will perform mass flash erase. This can
-        # take a lot of time, so we must change the timeout setting.
-        previous_timeout = self.scaffold.timeout
-        self.scaffold.timeout = 30
-        try:
+        # take a lot of time, so we must change the timeout setting. It is
+        # restored when leaving the section, even if something bad happened!
+        with self.scaffold.timeout_section(30):
             self.wait_ack()
-        finally:
-            # Restore timeout setting, even if something bad happened!
-            self.scaffold.timeout = previous_timeout
 
     def write_protect(self, sectors: List[int]):
         """
@@ -353,20 +429,17 @@ class STM32:
         """
         if len(sectors) not in range(1, 0x100):
             raise ValueError("Invalid sector count")
-        self.uart.transmit(b'\x63\x9c')
+        self.uart.transmit(_CMD_WRITE_PROTECT)
         self.wait_ack()
-        buf = bytearray()
-        buf.append(len(sectors)-1)
-        buf += bytes(sectors)
-        buf.append(self.checksum(buf))
-        self.uart.transmit(buf)
+        self.transmit_with_checksum(
+            bytes((len(sectors) - 1,)) + bytes(sectors))
         self.wait_ack()
 
     def write_unprotect(self):
         """
         Execute Write Unprotect command.
         """
-        self.uart.transmit(b'\x73\x8c')
+        self.uart.transmit(_CMD_WRITE_UNPROTECT)
         self.wait_ack()
         self.wait_ack()
 
@@ -375,17 +448,13 @@ class STM32:
         Execute the Extended Erase command to erase all the Flash memory of the
         device.
         """
-        self.uart.transmit(b'\x44\xbb')
+        self.uart.transmit(_CMD_EXTENDED_ERASE)
         self.wait_ack()
-        buf = bytearray(b'\xff\xff')
-        buf.append(self.checksum(buf))
-        self.uart.transmit(buf, 1)
-        previous_timeout = self.scaffold.timeout
-        self.scaffold.timeout = 30
-        try:
+        # Special code 0xffff for global mass erase.
+        self.transmit_with_checksum(b'\xff\xff', 1)
+        # Mass erase can be very long.
+        with self.scaffold.timeout_section(30):
             self.wait_ack()
-        finally:
-            self.scaffold.timeout = previous_timeout
 
     def go(self, address, trigger=0):
         """
@@ -394,9 +463,7 @@ class STM32:
         :param address: Jump address.
         :param trigger: 1 to enable trigger on command transmission.
         """
-        self.uart.transmit(b'\x21\xde', trigger=trigger)
+        self.uart.transmit(_CMD_GO, trigger=trigger)
         self.wait_ack()
-        buf = bytearray(address.to_bytes(4, 'big', signed=False))
-        buf.append(self.checksum(buf))
-        self.uart.transmit(buf)
+        self.transmit_with_checksum(_pack_address(address))
         self.wait_ack()
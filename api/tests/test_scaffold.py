@@ -0,0 +1,35 @@
+# This file is part of Scaffold
+#
+# Scaffold is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2019 Ledger SAS, written by Olivier Hériveaux
+
+
+from scaffold import xor_bytes
+import unittest
+
+
+class TestXorBytes(unittest.TestCase):
+    def test_xor_bytes(self):
+        for n in range(40):
+            data = bytes((i * 37 + n) & 0xff for i in range(n))
+            expected = 0
+            for b in data:
+                expected ^= b
+            self.assertEqual(xor_bytes(data), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
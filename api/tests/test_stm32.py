@@ -0,0 +1,108 @@
+# This file is part of Scaffold
+#
+# Scaffold is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2019 Ledger SAS, written by Olivier Hériveaux
+
+
+from scaffold import xor_bytes
+from scaffold.stm32 import STM32, _CMD_WRITE_MEMORY, _pack_address
+import io
+import unittest
+
+
+class _StubSignal:
+    """ Signal which accepts any connection, for unit testing. """
+    def __lshift__(self, other):
+        pass
+
+
+class _StubUART:
+    """
+    UART which records all transmitted bytes and always receives ACK bytes,
+    for unit testing.
+    """
+    def __init__(self):
+        self.rx = _StubSignal()
+        self.tx = _StubSignal()
+        self.baudrate = None
+        self.transmitted = bytearray()
+
+    def transmit(self, data, trigger=0):
+        self.transmitted += data
+
+    def receive(self, n):
+        return bytes((STM32.ACK,)) * n
+
+
+class _StubScaffold:
+    """ Scaffold board with only what STM32 needs, for unit testing. """
+    def __init__(self):
+        self.timeout = None
+        self.d0 = self.d1 = self.d2 = self.d6 = self.d7 = _StubSignal()
+        self.uart0 = _StubUART()
+
+
+class TestChecksum(unittest.TestCase):
+    def test_address_frames(self):
+        # 4-byte frames have their own code path in checksum.
+        stm = STM32(_StubScaffold())
+        for address in (0, 0x08000000, 0x12345678, 0xffffffff):
+            data = _pack_address(address)
+            self.assertEqual(stm.checksum(data), xor_bytes(data))
+
+
+class _ShortReadFile(io.RawIOBase):
+    """ Binary file reading at most 100 bytes at once, for unit testing. """
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.data.readinto(memoryview(b)[:100])
+
+
+class TestWriteMemory(unittest.TestCase):
+    def write(self, data):
+        """ :return: Bytes transmitted for writing data at 0x08000000. """
+        stm = STM32(_StubScaffold())
+        stm.write_memory(0x08000000, data)
+        return bytes(stm.uart.transmitted)
+
+    def test_inputs(self):
+        for size in (4, 256, 600, 602):
+            data = bytes((i * 7) & 0xff for i in range(size))
+            padded = data + b'\xff' * (-size % 4)
+            expected = self.write(padded)
+            self.assertEqual(self.write(data), expected)
+            self.assertEqual(self.write(bytearray(data)), expected)
+            self.assertEqual(self.write(io.BytesIO(data)), expected)
+            self.assertEqual(self.write(_ShortReadFile(data)), expected)
+
+    def test_pages(self):
+        data = bytes(range(256)) * 2 + b'\x01\x02'
+        transmitted = self.write(data)
+        # Third page is at 0x08000200 and padded to 4 bytes.
+        address = _pack_address(0x08000200)
+        page = b'\x03\x01\x02\xff\xff'
+        self.assertTrue(transmitted.endswith(_CMD_WRITE_MEMORY + address
+            + bytes((xor_bytes(address),)) + page
+            + bytes((xor_bytes(page),))))
+
+
+if __name__ == '__main__':
+    unittest.main()
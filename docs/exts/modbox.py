@@ -24,20 +24,87 @@ This is a custom extension for sphinx to generate modules figures.
 """
 
 
-import matplotlib
-# Change backend to agg as workaround for import troubles with tkinter when
-# building with readthedocs.io docker image.
-matplotlib.use('agg')
-import matplotlib.pyplot as plt
-import matplotlib.lines as lines
-import matplotlib.patches as patches
 import os.path
+from concurrent.futures import ProcessPoolExecutor
 from docutils import nodes
 from docutils.parsers.rst import Directive, directives
-from hashlib import sha1
+from hashlib import blake2b
+from sphinx.config import ENUM
+from sphinx.errors import ConfigError
 
 
-def make_fig(path, inputs, outputs):
+# Version of the drawing code. Must be incremented when the output of make_fig
+# changes, so figures generated by previous builds are not reused.
+FIG_VERSION = 1
+
+# Figure and axes reused by all make_fig calls of a process, since creating
+# them is the most expensive part of drawing a figure.
+_FIG = None
+_AX = None
+
+# Supported values of the modbox_format option.
+FORMATS = ('svg', 'png')
+
+# Width of the module box and length of the input arrows, in figure units.
+BOX_W = 6
+ARROW_LENGTH_LEFT = 1
+
+# Resolution of the figures when a raster format is selected with the
+# modbox_format option.
+RASTER_DPI = 150
+
+
+def modbox_fname(inputs, outputs, fmt):
+    """
+    :param fmt: Image format, 'svg' or 'png' for instance.
+    :return: File name of the figure for the given inputs and outputs. It is
+        derived from the figure content, so a figure generated by a previous
+        build can be reused.
+    """
+    hashkey = 'v{0}|{1}'.format(FIG_VERSION, '-'.join(inputs + outputs))
+    digest = blake2b(hashkey.encode(), digest_size=8).hexdigest()
+    return 'modbox-{0}.{1}'.format(digest, fmt)
+
+
+def fig_layout(inputs, outputs):
+    """
+    Compute the dimensions of a module figure which depend on its signals.
+    They are used for drawing by make_fig, and for raster image size by the
+    HTML visitor.
+
+    :param outputs: Output names, with their '*' feedback markers.
+    :return: Tuple (box_h, arrow_length_right, width, height). box_h and
+        arrow_length_right are in figure units, width and height are the
+        figure size in inches.
+    """
+    num_feedback = sum(1 for name in outputs if name[-1] == '*')
+    box_h = max(len(inputs), len(outputs)) + 1
+    # Output arrows are longer when feedback lines go around them.
+    arrow_length_right = 1 + num_feedback
+    area_w = BOX_W + ARROW_LENGTH_LEFT + arrow_length_right + 2
+    area_h = box_h + 2 + num_feedback
+    return box_h, arrow_length_right, area_w * 0.3, area_h * 0.3
+
+
+def make_fig(path, inputs, outputs, dpi=None):
+    """
+    Draw a module figure. The image format is given by the extension of path.
+
+    :param dpi: Resolution for raster formats. None to use the figure one.
+    """
+    global _FIG, _AX
+    # matplotlib is imported only when a figure has to be drawn, since it is
+    # slow to load.
+    import matplotlib
+    # Change backend to agg as workaround for import troubles with tkinter when
+    # building with readthedocs.io docker image.
+    matplotlib.use('agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.lines as lines
+    import matplotlib.patches as patches
+
+    box_h, arrow_length_right, width, height = fig_layout(inputs, outputs)
+
     # Outputs with '*' goes back to the left matrix.
     # Count how many of them we have.
     feedback_signals = []
@@ -50,21 +117,22 @@ def make_fig(path, inputs, outputs):
     # Head length and head width for arrows
     hl = 0.25
     hw = hl * 0.75
-    box_w = 6
+    box_w = BOX_W
     box_left = -box_w//2
     box_right = -box_left
     top = 1
     text_margin = 0.2
-    box_h = max(len(inputs), len(outputs)) + 1
     box_bottom = -box_h+1
-    arrow_length_left = 1
-    arrow_length_right = 1 + len(feedback_signals)
-    area_w = box_w + arrow_length_left + arrow_length_right + 2
-    area_h = box_h + 2 + len(feedback_signals)
+    arrow_length_left = ARROW_LENGTH_LEFT
 
     # Setup plot size and bounds
-    plt.figure(figsize=(area_w * 0.3, area_h * 0.3), dpi=75)
-    ax = plt.axes()
+    if _FIG is None:
+        _FIG = plt.figure(figsize=(width, height), dpi=75)
+        _AX = _FIG.add_subplot(111)
+    else:
+        _AX.clear()
+        _FIG.set_size_inches(width, height)
+    ax = _AX
 
     r = patches.Rectangle((box_left, box_bottom), box_w, box_h, fill=False,
         lw=line_width)
@@ -73,7 +141,7 @@ def make_fig(path, inputs, outputs):
     for i, name in enumerate(inputs):
         ax.arrow(box_left - arrow_length_left, -i, arrow_length_left - hl, 0, fc='k', ec='k',
             head_length=hl, head_width=hw, lw=line_width)
-        ax.annotate(s=name, xy=(box_left + text_margin, -i),
+        ax.annotate(name, xy=(box_left + text_margin, -i),
             horizontalalignment='left', verticalalignment='center')
 
     num_feedback = 0
@@ -81,7 +149,7 @@ def make_fig(path, inputs, outputs):
     for i, name in enumerate(outputs):
         ax.arrow(box_right, -i, arrow_length_right - hl, 0, fc='k', ec='k',
             head_length=hl, head_width=hw, lw=line_width)
-        ax.annotate(s=name, xy=(box_right - text_margin, -i),
+        ax.annotate(name, xy=(box_right - text_margin, -i),
             horizontalalignment='right', verticalalignment='center')
         if name in feedback_signals:
             x0 = box_right + num_feedback + 1
@@ -93,24 +161,18 @@ def make_fig(path, inputs, outputs):
             ax.add_line(line)
             ax.arrow(x0, y1, x1 - x0, 0, fc='k', ec='k', head_length=hl,
                 head_width=hw, lw=line_width)
-            plt.scatter(x0, y0, s=6, color='black')
+            ax.scatter(x0, y0, s=6, color='black')
             num_feedback += 1
 
     # Configure axis after everything has been drawn, otherwise plotting
-    # anything for instance with plt.scatter(...) will change de view.
+    # anything for instance with ax.scatter(...) will change de view.
     ax.axis('equal')
     ax.set_xbound(
         box_left - arrow_length_left - 1, box_right + arrow_length_right + 1)
     ax.set_ybound(box_bottom - 1 - len(feedback_signals), top+1)
     ax.axis('off')
 
-    # Create the directories before trying to save.
-    # It seems sphinx may forget to create them.
-    dirname = os.path.dirname(path)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-
-    plt.savefig(path, transparent=True)
+    _FIG.savefig(path, transparent=True, dpi=dpi)
 
 
 class ModBoxNode(nodes.Element):
@@ -118,6 +180,7 @@ class ModBoxNode(nodes.Element):
         super().__init__()
         self.inputs = []
         self.outputs = []
+        self.fname = None
 
 
 def io_list(s):
@@ -137,23 +200,116 @@ class ModBoxDirective(Directive):
         node = ModBoxNode()
         node.inputs = io_list(self.options['inputs'])
         node.outputs = io_list(self.options['outputs'])
+        env = self.state.document.settings.env
+        node.fname = modbox_fname(
+            node.inputs, node.outputs, env.config.modbox_format)
+        # Figures are not drawn here. They are queued, per document, and drawn
+        # all together once every document has been read, see
+        # render_modbox_figures.
+        if not hasattr(env, 'modbox_queue'):
+            env.modbox_queue = {}
+        doc_queue = env.modbox_queue.setdefault(env.docname, {})
+        doc_queue[node.fname] = (node.inputs, node.outputs)
         return [node]
 
 
+def purge_modbox_queue(app, env, docname):
+    """
+    Forget the figures of a document which is going to be read again, or has
+    been removed.
+    """
+    if hasattr(env, 'modbox_queue'):
+        env.modbox_queue.pop(docname, None)
+
+
+def merge_modbox_queue(app, env, docnames, other):
+    """
+    Merge the figures queued by a parallel reader process.
+    """
+    if not hasattr(env, 'modbox_queue'):
+        env.modbox_queue = {}
+    other_queue = getattr(other, 'modbox_queue', {})
+    for docname in docnames:
+        if docname in other_queue:
+            env.modbox_queue[docname] = other_queue[docname]
+
+
+def render_modbox_figures(app, env):
+    """
+    Draw the queued figures which are not in the output directory yet. When
+    there are several of them, they are drawn in parallel on all cores.
+    """
+    if app.builder.format != 'html':
+        return
+    outdir = os.path.join(app.builder.outdir, app.builder.imagedir)
+    if app.config.modbox_format == 'svg':
+        dpi = None
+    else:
+        dpi = RASTER_DPI
+    # Documents may share identical figures, draw them once.
+    figures = {}
+    for doc_queue in getattr(env, 'modbox_queue', {}).values():
+        figures.update(doc_queue)
+    jobs = []
+    for fname, (inputs, outputs) in figures.items():
+        path = os.path.join(outdir, fname)
+        if not os.path.exists(path):
+            # make_fig modifies the outputs list, give it a copy.
+            jobs.append((path, list(inputs), list(outputs), dpi))
+    if not jobs:
+        return
+    # Create the directories before trying to save, once for all figures.
+    # It seems sphinx may forget to create them.
+    os.makedirs(outdir, exist_ok=True)
+    if len(jobs) > 1:
+        with ProcessPoolExecutor() as executor:
+            # Iterate over the results so errors raised in the workers are
+            # reported.
+            for _ in executor.map(make_fig, *zip(*jobs)):
+                pass
+    else:
+        for job in jobs:
+            make_fig(*job)
+
+
 def visit_modbox_node(self, node):
-    hashkey = '-'.join(node.inputs + node.outputs)
-    fname = 'modbox-{0}.svg'.format(sha1(hashkey.encode()).hexdigest())
-    outfn = os.path.join(self.builder.outdir, self.builder.imagedir, fname)
-    make_fig(outfn, node.inputs, node.outputs)
-    # Generate HTML tag
-    self.body.append('<center><img src="_images/{0}"/></center>'.format(fname))
+    # Figure has already been drawn by render_modbox_figures.
+    if self.builder.config.modbox_format == 'svg':
+        self.body.append(
+            '<center><img src="_images/{0}"/></center>'.format(node.fname))
+    else:
+        # Raster images are drawn with a higher resolution than the screen
+        # one. Give their size in CSS pixels (96 per inch) so they are
+        # displayed as large as SVG ones.
+        _, _, width, height = fig_layout(node.inputs, node.outputs)
+        self.body.append(
+            '<center><img src="_images/{0}" width="{1}" height="{2}"/>'
+            '</center>'.format(
+                node.fname, round(width * 96), round(height * 96)))
 
 
 def depart_modbox_node(self, node):
     pass
 
 
+def check_config(app, config):
+    """
+    Reject unsupported figure formats, which would give broken images.
+    """
+    if config.modbox_format not in FORMATS:
+        raise ConfigError('modbox_format must be one of {0}, got {1!r}'.format(
+            ', '.join(FORMATS), config.modbox_format))
+
+
 def setup(app):
     app.add_node(ModBoxNode, html=(visit_modbox_node, depart_modbox_node))
     app.add_directive('modbox', ModBoxDirective)
+    # Image format of the figures, 'svg' or 'png'. Changing it requires the
+    # documents to be read again since file names depend on it.
+    app.add_config_value('modbox_format', 'svg', 'env', ENUM(*FORMATS))
+    app.connect('config-inited', check_config)
+    app.connect('env-purge-doc', purge_modbox_queue)
+    app.connect('env-merge-info', merge_modbox_queue)
+    app.connect('env-updated', render_modbox_figures)
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
 
@@ -31,45 +31,29 @@ for baudrate in baudrates:
     divisor = int(system_frequency / baudrate) - 1
     real_baudrate = system_frequency / (divisor + 1)
     error = abs(real_baudrate - baudrate) / baudrate
-    print(error)
     table.append((
         str(baudrate),
         str(divisor),
         '{0:.3f}'.format(real_baudrate),
         '{0:.3f} %'.format(error * 100) ))
 
-# Get the size of the table
-row_count = len(table)
-col_count = len(table[0])
-
 # Calculate columns width
-col_sizes = []
-for i in range(col_count):
-    size = 0
-    for j in range(row_count):
-        size = max(size, len(table[j][i]))
-    col_sizes.append(size)
+col_sizes = [max(map(len, col)) for col in zip(*table)]
 
 def gen_bar(sizes, c = '-'):
-    result = '+'
-    for size in sizes:
-        result += c * (size + 2) + '+'
-    return result
+    return '+' + ''.join(c * (size + 2) + '+' for size in sizes)
 
 def gen_row(row, sizes):
-    result = '|'
-    for i, size in enumerate(sizes):
-        result += ' ' + row[i].rjust(size) + ' |'
-    return result
+    return '|' + ''.join(
+        ' ' + cell.rjust(size) + ' |' for cell, size in zip(row, sizes))
 
-rest = gen_bar(col_sizes) + '\n'
+lines = [gen_bar(col_sizes)]
 
-for i in range(row_count):
-    rest += gen_row(table[i], col_sizes) + '\n'
+for i, row in enumerate(table):
+    lines.append(gen_row(row, col_sizes))
     if i == 0:
-        bar = gen_bar(col_sizes, '=')
+        lines.append(gen_bar(col_sizes, '='))
     else:
-        bar = gen_bar(col_sizes, '-')
-    rest += bar + '\n'
+        lines.append(gen_bar(col_sizes, '-'))
 
-open('uart_baudrates.inc', 'w').write(rest)
+open('uart_baudrates.inc', 'w').write('\n'.join(lines) + '\n')
@@ -33,44 +33,44 @@ class SecAesAtMega(Smartcard):
 
     def set_key(self, key=[0]*16):        
         assert len(key)==16
-        answer = self.apdu( bytes([0x80,0x10,0x00,0x00,0x10]+list(key)))
+        answer = self.apdu( bytes([0x80,0x10,0x00,0x00,0x10]) + bytes(key))
         return answer == bytearray(b'\x90\x00')
 
     def get_key(self):
         answer = self.apdu( bytes([0x80,0x12,0x00,0x00,0x10]))
         assert answer[-2:] == bytearray(b'\x90\x00')
         assert len(answer) == 16 + 2
-        return list(answer[:16])
+        return bytes(answer[:16])
 
     def set_input(self, input=[0]*16):
         
         assert len(input)==16
-        answer = self.apdu( bytes([0x80,0x20,0x00,0x00,0x10]+list(input)))
+        answer = self.apdu( bytes([0x80,0x20,0x00,0x00,0x10]) + bytes(input))
         return answer == bytearray(b'\x90\x00')
 
     def get_input(self):
         answer = self.apdu( bytes([0x80,0x22,0x00,0x00,0x10]))
         assert answer[-2:] == bytearray(b'\x90\x00')
         assert len(answer) == 16 + 2
-        return list(answer[:16])
+        return bytes(answer[:16])
     
     def set_mask(self, mask=[0]*18):        
         assert len(mask)==18
-        answer = self.apdu( bytes([0x80,0x30,0x00,0x00,0x12]+list(mask)))
+        answer = self.apdu( bytes([0x80,0x30,0x00,0x00,0x12]) + bytes(mask))
         return answer == bytearray(b'\x90\x00')
 
     def get_mask(self):
         answer = self.apdu( bytes([0x80,0x32,0x00,0x00,0x12]))
         assert answer[-2:] == bytearray(b'\x90\x00')
         assert len(answer) == 18 + 2
-        return list(answer[:18])
+        return bytes(answer[:18])
 
 
     def get_output(self):
         answer = self.apdu( bytes([0x80,0x42,0x00,0x00,0x10]))
         assert answer[-2:] == bytearray(b'\x90\x00')
         assert len(answer) == 16 + 2
-        return list(answer[:16])
+        return bytes(answer[:16])
         
     def launch_aes(self):
         return self.apdu( bytes([0x80,0x52,0x00,0x00,0x00]), trigger='a') == bytearray(b'\x90\x00')
@@ -90,14 +90,14 @@ class SecAesAtMega(Smartcard):
             self.set_input(input)
             self.set_mask(mask)
             
-            assert all(key == self.get_key())
-            assert all(input == self.get_input())
-            assert all(mask == self.get_mask())
+            assert bytes(key) == self.get_key()
+            assert bytes(input) == self.get_input()
+            assert bytes(mask) == self.get_mask()
 
             self.launch_aes()
             output = self.get_output()
 
-            assert AES.new(bytes(key), AES.MODE_ECB).encrypt(bytes(input)) == bytes(output)
+            assert AES.new(bytes(key), AES.MODE_ECB).encrypt(bytes(input)) == output
             print("Test %d/%d OK, %fs"% (i+1,n,time.time()-start))
 
 
@@ -26,6 +26,16 @@ import sys
 import argparse
 
 
+def load_binary(path):
+    """
+    :return: Content of the binary file, padded with 0xff bytes to a multiple
+        of 4 bytes as required by the bootloader.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data + b'\xff' * (-len(data) % 4)
+
+
 # Arguments parsing
 parser = argparse.ArgumentParser(description='This script uses Scaffold to '
     'communicate with STM32 devices. It allows loading and executing code.')
@@ -92,10 +102,7 @@ if args.erase or ((args.load is not None) and (args.ram is None)):
 
 # Load binary file into Flash memory
 if (args.load is not None) and (args.ram is None):
-    data = bytearray(open(args.load, 'rb').read())
-    # Pad the data (multiple of 4 bytes is required)
-    while len(data) % 4:
-        data.append(0xff)
+    data = load_binary(args.load)
     print('Programming...')
     stm.write_memory(0x08000000, data)
     print('Verifying...')
@@ -104,10 +111,7 @@ if (args.load is not None) and (args.ram is None):
 
 if (args.load is not None) and (args.ram is not None):
     ram_addr = int(args.ram, 0)
-    data = bytearray(open(args.load, 'rb').read())
-    # Pad the data (multiple of 4 bytes is required)
-    while len(data) % 4:
-        data.append(0xff)
+    data = load_binary(args.load)
     print('Loading code in RAM...')
     stm.write_memory(ram_addr, data)
 